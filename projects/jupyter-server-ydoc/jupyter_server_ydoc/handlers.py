@@ -7,8 +7,9 @@ import asyncio
 import json
 import time
 import uuid
-from logging import Logger
-from typing import Any
+from collections import deque
+from logging import DEBUG, Logger
+from typing import Any, cast
 
 from jupyter_server.auth import authorized
 from jupyter_server.base.handlers import APIHandler, JupyterHandler
@@ -18,7 +19,7 @@ from pycrdt_websocket.websocket_server import YRoom
 from pycrdt_websocket.ystore import BaseYStore
 from pycrdt_websocket.yutils import YMessageType, write_var_uint
 from tornado import web
-from tornado.websocket import WebSocketHandler
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 
 from .loaders import FileLoaderMapping
 from .rooms import DocumentRoom, TransientRoom
@@ -36,6 +37,19 @@ YFILE = YDOCS["file"]
 
 SERVER_SESSION = str(uuid.uuid4())
 
+# Marks the end of the messages of a closed connection
+_EOF = object()
+
+# The session id is constant, so it is serialized once for all the session responses
+_SESSION_TEMPLATE = '{"format": %%s, "type": %%s, "fileId": %%s, "sessionId": %s}' % json.dumps(
+    SERVER_SESSION
+)
+
+
+def _session_response(format: str, content_type: str, file_id: str) -> str:
+    """Serialize the document session model returned by ``DocSessionHandler``."""
+    return _SESSION_TEMPLATE % (json.dumps(format), json.dumps(content_type), json.dumps(file_id))
+
 
 class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
     """`YDocWebSocketHandler` uses the singleton pattern for ``WebsocketServer``,
@@ -50,16 +64,28 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
     Tornado's WebSocket API is different, so ``YDocWebSocketHandler`` needs to be adapted:
 
     - ``YDocWebSocketHandler`` is an async iterator, that will yield received messages.
-       Messages received in Tornado's `on_message(message)` are put in an async
-       ``_message_queue``, from which we get them asynchronously.
-    - The ``send(message)`` method is async and calls Tornado's ``write_message(message)``.
+       Messages received in Tornado's `on_message(message)` are appended to the
+       ``_messages`` deque, from which we get them asynchronously. A single
+       ``_waiter`` future is used to wake up the consumer when the deque is empty.
+    - The ``send(message)`` method is async and appends the message to the ``_out_messages``
+       deque without waiting. A ``_writer`` task passes all the pending messages to Tornado's
+       ``write_message(message)`` at once, so that they can be written together, and waits for
+       them to be flushed before taking the next batch. There is no backpressure on ``send``:
+       the messages sent while a batch is being flushed are kept in the deque.
     - Although it's currently not used in ypy-websocket, ``recv()`` is an async method for
-       receiving a message.
+       receiving a message and ``recv_many()`` is an async method for receiving all the
+       pending messages at once.
     """
 
-    _message_queue: asyncio.Queue[Any]
+    _messages: deque[Any]
+    _waiter: asyncio.Future[None] | None
+    _out_messages: deque[bytes]
+    _out_waiter: asyncio.Future[None] | None
+    _writer: asyncio.Task | None
     _background_tasks: set[asyncio.Task]
     _room_locks: dict[str, asyncio.Lock] = {}
+    # Override max_message size to 1GB
+    max_message_size: int = 1024 * 1024 * 1024
 
     def _room_lock(self, room_id: str) -> asyncio.Lock:
         if room_id not in self._room_locks:
@@ -70,6 +96,7 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         task = asyncio.create_task(aw)
         self._background_tasks.add(task)
         task.add_done_callback(self._background_tasks.discard)
+        return task
 
     async def prepare(self):
         await ensure_async(super().prepare())
@@ -79,10 +106,13 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
 
         # Get room
         self._room_id: str = room_id_from_encoded_path(self.request.path)
+        if self._room_id.count(":") >= 2:
+            self._file_format, self._file_type, self._file_id = decode_file_path(self._room_id)
 
         async with self._room_lock(self._room_id):
             if self._websocket_server.room_exists(self._room_id):
                 self.room: YRoom = await self._websocket_server.get_room(self._room_id)
+                self._is_document_room = isinstance(self.room, DocumentRoom)
             else:
                 # Logging exceptions, instead of raising them here to ensure
                 # that the y-rooms stay alive even after an exception is seen.
@@ -99,23 +129,23 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                     )
                     return True
 
-                if self._room_id.count(":") >= 2:
+                if self._file_id:
                     # DocumentRoom
-                    file_format, file_type, file_id = decode_file_path(self._room_id)
-                    if file_id in self._file_loaders:
+                    if self._file_id in self._file_loaders:
                         self._emit(
                             LogLevel.WARNING,
                             None,
                             "There is another collaborative session accessing the same file.\nThe synchronization between rooms is not supported and you might lose some of your changes.",
                         )
 
-                    file = self._file_loaders[file_id]
-                    updates_file_path = f".{file_type}:{file_id}.y"
+                    file = self._file_loaders[self._file_id]
+                    updates_file_path = f".{self._file_type}:{self._file_id}.y"
                     ystore = self._ystore_class(path=updates_file_path, log=self.log)
+                    self._is_document_room = True
                     self.room = DocumentRoom(
                         self._room_id,
-                        file_format,
-                        file_type,
+                        self._file_format,
+                        self._file_type,
                         file,
                         self.event_logger,
                         ystore,
@@ -127,6 +157,7 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                 else:
                     # TransientRoom
                     # it is a transient document (e.g. awareness)
+                    self._is_document_room = False
                     self.room = TransientRoom(
                         self._room_id,
                         log=self.log,
@@ -143,14 +174,14 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                 self._emit(LogLevel.INFO, "clean", "Room deleted.")
 
                 # Clean the file loader in file loader mapping if there are not any rooms using it
-                _, _, file_id = decode_file_path(self._room_id)
-                file = self._file_loaders[file_id]
-                if file.number_of_subscriptions == 0 or (
-                    file.number_of_subscriptions == 1 and self._room_id in file._subscriptions
-                ):
-                    self.log.info("Deleting file %s", file.path)
-                    await self._file_loaders.remove(file_id)
-                    self._emit(LogLevel.INFO, "clean", "file loader removed.")
+                if self._file_id:
+                    file = self._file_loaders[self._file_id]
+                    if file.number_of_subscriptions == 0 or (
+                        file.number_of_subscriptions == 1 and self._room_id in file._subscriptions
+                    ):
+                        self.log.info("Deleting file %s", file.path)
+                        await self._file_loaders.remove(self._file_id)
+                        self._emit(LogLevel.INFO, "clean", "file loader removed.")
                 raise e
             self._websocket_server.add_room(self._room_id, self.room)
 
@@ -170,9 +201,17 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         self._cleanup_delay = document_cleanup_delay
         self._document_save_delay = document_save_delay
         self._websocket_server = ywebsocket_server
-        self._message_queue = asyncio.Queue()
+        self._messages = deque()
+        self._waiter = None
+        self._out_messages = deque()
+        self._out_waiter = None
+        self._writer = None
         self._room_id = ""
+        self._file_format = ""
+        self._file_type = ""
+        self._file_id = ""
         self.room = None
+        self._is_document_room = False
 
     @property
     def path(self):
@@ -182,23 +221,31 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         """
         return self._room_id
 
-    @property
-    def max_message_size(self):
-        """
-        Override max_message size to 1GB
-        """
-        return 1024 * 1024 * 1024
-
     def __aiter__(self):
         # needed to be compatible with WebsocketServer (async for message in websocket)
         return self
 
     async def __anext__(self):
         # needed to be compatible with WebsocketServer (async for message in websocket)
-        message = await self._message_queue.get()
-        if not message:
+        await self._wait_message()
+        if self._messages[0] is _EOF:
             raise StopAsyncIteration()
-        return message
+        return self._messages.popleft()
+
+    def _put_message(self, message: Any) -> None:
+        self._messages.append(message)
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _wait_message(self) -> None:
+        if self._messages:
+            return
+        self._waiter = asyncio.get_running_loop().create_future()
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
 
     async def get(self, *args, **kwargs):
         """
@@ -213,9 +260,11 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         """
         On connection open.
         """
+        self._writer = self.create_task(self._write_messages())
         self.create_task(self._websocket_server.serve(self))
 
-        if isinstance(self.room, DocumentRoom):
+        if self._is_document_room:
+            room = cast(DocumentRoom, self.room)
             # Close the connection if the document session expired
             session_id = self.get_query_argument("sessionId", "")
             if SERVER_SESSION != session_id:
@@ -225,17 +274,16 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                 )
 
             # cancel the deletion of the room if it was scheduled
-            if self.room.cleaner is not None:
-                self.room.cleaner.cancel()
+            if room.cleaner is not None:
+                room.cleaner.cancel()
 
             try:
                 # Initialize the room
                 async with self._room_lock(self._room_id):
-                    await self.room.initialize()
+                    await room.initialize()
                 self._emit_awareness_event(self.current_user.username, "join")
             except Exception as e:
-                _, _, file_id = decode_file_path(self._room_id)
-                file = self._file_loaders[file_id]
+                file = self._file_loaders[self._file_id]
 
                 # Close websocket and propagate error.
                 if isinstance(e, web.HTTPError):
@@ -249,8 +297,9 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                     )
 
                 # Clean up the room and delete the file loader
-                if len(self.room.clients) == 0 or self.room.clients == [self]:
-                    self._message_queue.put_nowait(b"")
+                clients = self.room.clients
+                if len(clients) == 0 or (len(clients) == 1 and clients[0] is self):
+                    self._put_message(_EOF)
                     self._cleanup_delay = 0
                     await self._clean_room()
 
@@ -264,51 +313,101 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         Send a message to the client.
         """
         # needed to be compatible with WebsocketServer (websocket.send)
-        try:
-            self.write_message(message, binary=True)
-        except Exception as e:
-            self.log.error("Failed to write message", exc_info=e)
+        if self._writer is None or self._writer.done():
+            # the connection is closed
+            return
+        self._out_messages.append(message)
+        waiter = self._out_waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    async def _write_messages(self) -> None:
+        """
+        Async task writing the messages to send to the client.
+
+        All the pending messages are written in one go and only the future of
+        the last write is awaited, as it resolves once all of them are flushed.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            if not self._out_messages:
+                self._out_waiter = loop.create_future()
+                try:
+                    await self._out_waiter
+                finally:
+                    self._out_waiter = None
+            try:
+                while self._out_messages:
+                    flushed = self.write_message(self._out_messages.popleft(), binary=True)
+                await flushed
+            except WebSocketClosedError:
+                self._out_messages.clear()
+                return
+            except Exception as e:
+                self.log.error("Failed to write message", exc_info=e)
 
     async def recv(self):
         """
         Receive a message from the client.
+
+        It returns an empty message once the connection is closed.
+        """
+        await self._wait_message()
+        if self._messages[0] is _EOF:
+            return b""
+        return self._messages.popleft()
+
+    async def recv_many(self, max_items: int = 64) -> list[bytes]:
+        """
+        Receive all the pending messages from the client, up to ``max_items``.
+
+        It waits only if no message is pending and returns an empty
+        list once the connection is closed.
         """
-        message = await self._message_queue.get()
-        return message
+        await self._wait_message()
+        messages: list[bytes] = []
+        while self._messages and len(messages) < max_items:
+            if self._messages[0] is _EOF:
+                # keep the end of stream marker for the next consumer
+                break
+            messages.append(self._messages.popleft())
+        return messages
 
     async def on_message(self, message):
         """
         On message receive.
         """
+        if not message:
+            # empty frames do not carry any Y message
+            self.log.debug("Ignoring empty message in room %s", self._room_id)
+            return
+
         message_type = message[0]
 
-        if message_type == YMessageType.AWARENESS:
+        # awareness changes are only tracked for debugging purposes, so skip
+        # decoding them if they would not be logged
+        if message_type == YMessageType.AWARENESS and self.log.isEnabledFor(DEBUG):
             # awareness
-            skip = False
+            # the awareness decoder calls bytes.decode on the states, so it cannot
+            # be given a memoryview; the copy is only made when debugging
             changes = self.room.awareness.get_changes(message[1:])
             added_users = changes["added"]
             removed_users = changes["removed"]
-            for i, user in enumerate(added_users):
-                u = changes["states"][i]
-                if "user" in u:
-                    name = u["user"]["name"]
+            # states holds the updated clients too, so get the state of each added client
+            states = self.room.awareness.states
+            for user in added_users:
+                name = states.get(user, {}).get("user", {}).get("name")
+                if name:
                     self._websocket_server.connected_users[user] = name
                     self.log.debug("Y user joined: %s", name)
             for user in removed_users:
-                if user in self._websocket_server.connected_users:
-                    name = self._websocket_server.connected_users[user]
-                    del self._websocket_server.connected_users[user]
+                name = self._websocket_server.connected_users.pop(user, None)
+                if name is not None:
                     self.log.debug("Y user left: %s", name)
-            # filter out message depending on changes
-            if skip:
-                self.log.debug(
-                    "Filtered out Y message of type: %s",
-                    YMessageType(message_type).name,
-                )
-                return skip
 
         if message_type == MessageType.CHAT:
-            msg = message[2:].decode("utf-8")
+            # decode the payload in place instead of copying it first
+            msg = str(memoryview(message)[2:], "utf-8")
 
             user = self.current_user
             data = json.dumps(
@@ -318,16 +417,15 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
                     "content": json.loads(msg),
                 }
             ).encode("utf8")
+            chat_message = bytes([MessageType.CHAT]) + write_var_uint(len(data)) + data
 
+            # send only queues the message for the client writer task,
+            # so there is no need to spawn a task per client
             for client in self.room.clients:
                 if client != self:
-                    task = asyncio.create_task(
-                        client.send(bytes([MessageType.CHAT]) + write_var_uint(len(data)) + data)
-                    )
-                    self._websocket_server.background_tasks.add(task)
-                    task.add_done_callback(self._websocket_server.background_tasks.discard)
+                    await client.send(chat_message)
 
-        self._message_queue.put_nowait(message)
+        self._put_message(message)
         self._websocket_server.ypatch_nb += 1
 
     def on_close(self) -> None:
@@ -335,18 +433,25 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
         On connection close.
         """
         # stop serving this client
-        self._message_queue.put_nowait(b"")
-        if isinstance(self.room, DocumentRoom) and self.room.clients == [self]:
+        self._put_message(_EOF)
+        if self._writer is not None:
+            self._writer.cancel()
+        self._out_messages.clear()
+        clients = self.room.clients
+        if self._is_document_room and len(clients) == 1 and clients[0] is self:
             # no client in this room after we disconnect
             # keep the document for a while in case someone reconnects
             self.log.info("Cleaning room: %s", self._room_id)
-            self.room.cleaner = asyncio.create_task(self._clean_room())
+            self.room.cleaner = asyncio.create_task(self._clean_room_later())
         if self._room_id != "JupyterLab:globalAwareness":
             self._emit_awareness_event(self.current_user.username, "leave")
 
     def _emit(self, level: LogLevel, action: str | None = None, msg: str | None = None) -> None:
-        _, _, file_id = decode_file_path(self._room_id)
-        path = self._file_id_manager.get_path(file_id)
+        if not self._file_id:
+            # Only document rooms are bound to a file
+            return
+
+        path = self._file_id_manager.get_path(self._file_id)
 
         data = {"level": level.value, "room": self._room_id, "path": path}
         if action:
@@ -363,26 +468,45 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
 
         self.event_logger.emit(schema_id=JUPYTER_COLLABORATION_AWARENESS_EVENTS_URI, data=data)
 
-    async def _clean_room(self) -> None:
+    async def _clean_room_later(self) -> None:
         """
-        Async task for cleaning up the resources.
+        Async task for cleaning up the resources after a delay.
 
         When all the clients of a room leave, we setup a task to clean up the resources
         after a certain amount of time. We need to wait a few seconds to clean up the room
         because sometimes websockets unintentionally disconnect.
 
+        The task is cancelled if a client reconnects to the room during the delay.
+        """
+        if self._cleanup_delay is None:
+            return
+
+        try:
+            await asyncio.sleep(self._cleanup_delay)
+        except asyncio.CancelledError:
+            # A client reconnected to the room
+            return
+
+        await self._clean_room()
+
+    async def _clean_room(self) -> None:
+        """
+        Cleans up the resources.
+
         During the clean up, we need to delete the room to free resources since the room
         contains a copy of the document. In addition, we remove the file if there is no rooms
         subscribed to it.
         """
-        assert isinstance(self.room, DocumentRoom)
+        assert self._is_document_room
 
         if self._cleanup_delay is None:
             return
 
-        await asyncio.sleep(self._cleanup_delay)
-
         async with self._room_lock(self._room_id):
+            if self._websocket_server.rooms.get(self._room_id) is not self.room:
+                # The room has already been cleaned up
+                return
+
             # Remove the room from the websocket server
             self.log.info("Deleting Y document from memory: %s", self._room_id)
             await self._websocket_server.delete_room(room=self.room)
@@ -393,11 +517,10 @@ class YDocWebSocketHandler(WebSocketHandler, JupyterHandler):
             self._emit(LogLevel.INFO, "clean", "Room deleted.")
 
             # Clean the file loader if there are not rooms using it
-            _, _, file_id = decode_file_path(self._room_id)
-            file = self._file_loaders[file_id]
+            file = self._file_loaders[self._file_id]
             if file.number_of_subscriptions == 0:
                 self.log.info("Deleting file %s", file.path)
-                await self._file_loaders.remove(file_id)
+                await self._file_loaders.remove(self._file_id)
                 self._emit(LogLevel.INFO, "clean", "Loader deleted.")
             del self._room_locks[self._room_id]
 
@@ -421,25 +544,20 @@ class DocSessionHandler(APIHandler):
         """
         Creates a new session for a given document or returns an existing one.
         """
-        body = json.loads(self.request.body)
-        format = body["format"]
-        content_type = body["type"]
+        try:
+            body = json.loads(self.request.body)
+            format = body["format"]
+            content_type = body["type"]
+        except (ValueError, KeyError, TypeError) as e:
+            raise web.HTTPError(400, "Invalid document session request") from e
         file_id_manager = self.settings["file_id_manager"]
 
         idx = file_id_manager.get_id(path)
         if idx is not None:
             # index already exists
             self.log.info("Request for Y document '%s' with room ID: %s", path, idx)
-            data = json.dumps(
-                {
-                    "format": format,
-                    "type": content_type,
-                    "fileId": idx,
-                    "sessionId": SERVER_SESSION,
-                }
-            )
             self.set_status(200)
-            return self.finish(data)
+            return self.finish(_session_response(format, content_type, idx))
 
         # try indexing
         idx = file_id_manager.index(path)
@@ -449,13 +567,5 @@ class DocSessionHandler(APIHandler):
 
         # index successfully created
         self.log.info("Request for Y document '%s' with room ID: %s", path, idx)
-        data = json.dumps(
-            {
-                "format": format,
-                "type": content_type,
-                "fileId": idx,
-                "sessionId": SERVER_SESSION,
-            }
-        )
         self.set_status(201)
-        return self.finish(data)
+        return self.finish(_session_response(format, content_type, idx))
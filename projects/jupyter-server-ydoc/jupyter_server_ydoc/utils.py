@@ -74,4 +74,5 @@ def encode_file_path(format: str, file_type: str, file_id: str) -> str:
 
 def room_id_from_encoded_path(encoded_path: str) -> str:
     """Transforms the encoded path into a stable room identifier."""
-    return encoded_path.split("/")[-1]
+    # The last path segment, without splitting the whole path
+    return encoded_path.rpartition("/")[2]
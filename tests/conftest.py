@@ -6,14 +6,18 @@ import json
 from asyncio import Event, create_task, sleep
 from datetime import datetime
 from typing import Any
+from unittest.mock import Mock
 
 import nbformat
 import pytest
+from jupyter_server_ydoc.handlers import YDocWebSocketHandler
 from jupyter_server_ydoc.loaders import FileLoader
 from jupyter_server_ydoc.rooms import DocumentRoom
 from jupyter_server_ydoc.stores import SQLiteYStore
 from jupyter_ydoc import YNotebook, YUnicode
 from pycrdt_websocket import WebsocketProvider
+from tornado.httputil import HTTPServerRequest
+from tornado.web import Application
 from websockets import connect
 
 from .utils import FakeContentsManager, FakeEventLogger, FakeFileIDManager
@@ -27,7 +31,14 @@ def rtc_document_save_delay():
 
 
 @pytest.fixture
-def jp_server_config(jp_root_dir, jp_server_config, rtc_document_save_delay):
+def rtc_document_cleanup_delay():
+    return 60
+
+
+@pytest.fixture
+def jp_server_config(
+    jp_root_dir, jp_server_config, rtc_document_save_delay, rtc_document_cleanup_delay
+):
     return {
         "ServerApp": {
             "jpserver_extensions": {"jupyter_server_ydoc": True, "jupyter_server_fileid": True},
@@ -41,7 +52,10 @@ def jp_server_config(jp_root_dir, jp_server_config, rtc_document_save_delay):
             "db_path": str(jp_root_dir.joinpath(".fid_test.db")),
             "db_journal_mode": "OFF",
         },
-        "YDocExtension": {"document_save_delay": rtc_document_save_delay},
+        "YDocExtension": {
+            "document_save_delay": rtc_document_save_delay,
+            "document_cleanup_delay": rtc_document_cleanup_delay,
+        },
     }
 
 
@@ -225,3 +239,22 @@ def rtc_create_mock_document_room():
         )
 
     return _inner
+
+
+@pytest.fixture
+def rtc_create_ws_handler():
+    """Creates a room websocket handler that is not bound to a connection."""
+
+    def _inner(room_id: str = "text:file:test-id", **kwargs: Any) -> YDocWebSocketHandler:
+        app = Application(file_id_manager=FakeFileIDManager({}))
+        request = HTTPServerRequest(
+            method="GET", uri=f"/api/collaboration/room/{room_id}", connection=Mock()
+        )
+        options = {"ywebsocket_server": None, "file_loaders": None, "ystore_class": None}
+        options.update(kwargs)
+        handler = YDocWebSocketHandler(app, request, **options)
+        # set by prepare when the handler serves a request
+        handler._room_id = room_id
+        return handler
+
+    return _inner
@@ -4,12 +4,22 @@
 from __future__ import annotations
 
 import json
-from asyncio import Event, sleep
-from typing import Any
+import logging
+from asyncio import Event, Future, create_task, get_running_loop, sleep, wait_for
+from types import SimpleNamespace
+from typing import Any, Callable
+from unittest.mock import AsyncMock, Mock
 
+import pytest
 from jupyter_events.logger import EventLogger
+from jupyter_server_ydoc.handlers import _EOF
+from jupyter_server_ydoc.rooms import TransientRoom
+from jupyter_server_ydoc.utils import MessageType, room_id_from_encoded_path
 from jupyter_ydoc import YUnicode
 from pycrdt_websocket import WebsocketProvider
+from pycrdt_websocket.yutils import write_var_uint
+from tornado.httpclient import HTTPClientError
+from tornado.websocket import WebSocketClosedError
 
 
 async def test_session_handler_should_create_session_id(
@@ -53,6 +63,16 @@ async def test_session_handler_should_respond_with_session_id(
     assert data["sessionId"]
 
 
+@pytest.mark.parametrize("body", ["not json", json.dumps({"format": "text"}), json.dumps([])])
+async def test_session_handler_should_reject_invalid_body(body, rtc_create_file, jp_fetch):
+    file_path = "sessionID_3.txt"
+    await rtc_create_file(file_path)
+
+    with pytest.raises(HTTPClientError) as e:
+        await jp_fetch("/api/collaboration/session", file_path, method="PUT", body=body)
+    assert e.value.code == 400
+
+
 async def test_session_handler_should_respond_with_not_found(rtc_fetch_session):
     # TODO: Fix session handler
     # File ID manager allays returns an index, even if the file doesn't exist
@@ -86,6 +106,41 @@ async def test_room_handler_doc_client_should_connect(rtc_create_file, rtc_conne
     assert doc.source == content
 
 
+async def test_room_handler_doc_client_should_forward_chat_message(
+    rtc_create_file, rtc_connect_doc_client, jp_serverapp, caplog
+):
+    path, _ = await rtc_create_file("chat.txt", "test")
+    content = json.dumps({"body": "hello"}).encode("utf8")
+    ywebsocket_server = jp_serverapp.web_app.settings["jupyter_server_ydoc"].ywebsocket_server
+
+    async with await rtc_connect_doc_client(
+        "text", "file", path
+    ) as sender, await rtc_connect_doc_client("text", "file", path) as receiver:
+        fim = jp_serverapp.web_app.settings["file_id_manager"]
+        room_id = f"text:file:{fim.get_id(path)}"
+
+        async def _both_clients_joined() -> None:
+            while room_id not in ywebsocket_server.rooms or (
+                len(ywebsocket_server.rooms[room_id].clients) < 2
+            ):
+                await sleep(0.01)
+
+        await wait_for(_both_clients_joined(), timeout=5)
+        ypatch_nb = ywebsocket_server.ypatch_nb
+        await sender.send(bytes([MessageType.CHAT]) + write_var_uint(len(content)) + content)
+
+        message = await wait_for(receiver.recv(), timeout=5)
+        while message[0] != MessageType.CHAT:
+            message = await wait_for(receiver.recv(), timeout=5)
+
+    data = json.loads(message[2:])
+    assert data["content"] == {"body": "hello"}
+    assert data["sender"]
+    # the chat message went through on_message up to the room queue
+    assert ywebsocket_server.ypatch_nb == ypatch_nb + 1
+    assert not [r for r in caplog.records if "Uncaught exception" in r.getMessage()]
+
+
 async def test_room_handler_doc_client_should_emit_awareness_event(
     rtc_create_file, rtc_connect_doc_client, jp_serverapp
 ):
@@ -215,3 +270,220 @@ async def test_room_handler_doc_client_should_cleanup_room_file(
 
     await jp_serverapp.web_app.settings["jupyter_server_ydoc"].stop_extension()
     del jp_serverapp.web_app.settings["file_id_manager"]
+
+
+async def test_room_handler_recv_many_should_return_pending_messages_at_once(
+    rtc_create_ws_handler,
+):
+    handler = rtc_create_ws_handler()
+
+    task = create_task(handler.recv_many())
+    await sleep(0)
+    assert not task.done()
+
+    for message in (b"\x00a", b"\x00b", b"\x01c"):
+        handler._put_message(message)
+
+    assert await wait_for(task, timeout=1) == [b"\x00a", b"\x00b", b"\x01c"]
+
+
+async def test_room_handler_recv_many_should_limit_the_batch_size(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler()
+    messages = [bytes([0, i]) for i in range(5)]
+    for message in messages:
+        handler._put_message(message)
+
+    assert await handler.recv_many(max_items=2) == messages[:2]
+    assert await handler.recv_many(max_items=2) == messages[2:4]
+    assert await handler.recv_many(max_items=2) == messages[4:]
+
+
+async def test_room_handler_recv_many_should_stop_at_the_end_of_stream(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler()
+    handler._put_message(b"\x00a")
+    handler._put_message(b"\x00b")
+    handler._put_message(_EOF)
+
+    assert await handler.recv_many() == [b"\x00a", b"\x00b"]
+    assert list(handler._messages) == [_EOF]
+    # once closed, the end of stream is returned to every consumer
+    assert await handler.recv_many() == []
+    assert await handler.recv() == b""
+    with pytest.raises(StopAsyncIteration):
+        await handler.__anext__()
+
+
+async def test_room_handler_should_ignore_empty_messages(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler()
+
+    await handler.on_message(b"")
+
+    assert len(handler._messages) == 0
+
+
+def _awareness_message(*clients: tuple[int, int, dict]) -> bytes:
+    update = write_var_uint(len(clients))
+    for client_id, clock, state in clients:
+        encoded_state = json.dumps(state).encode("utf8")
+        update += write_var_uint(client_id) + write_var_uint(clock)
+        update += write_var_uint(len(encoded_state)) + encoded_state
+    return bytes([MessageType.AWARENESS]) + write_var_uint(len(update)) + update
+
+
+async def test_room_handler_should_track_awareness_user_names(rtc_create_ws_handler, caplog):
+    caplog.set_level(logging.DEBUG)
+    server = SimpleNamespace(connected_users={}, ypatch_nb=0)
+    handler = rtc_create_ws_handler("JupyterLab:globalAwareness", ywebsocket_server=server)
+    handler.room = TransientRoom("JupyterLab:globalAwareness", log=logging.getLogger())
+
+    await handler.on_message(_awareness_message((1, 1, {"user": {"name": "alice"}})))
+    # the updated client state comes before the state of the added client
+    await handler.on_message(
+        _awareness_message((1, 2, {"user": {"name": "alice"}}), (2, 1, {"user": {"name": "bob"}}))
+    )
+
+    assert server.connected_users == {1: "alice", 2: "bob"}
+
+
+class FakeWriter:
+    """Records the messages written by a room handler."""
+
+    def __init__(self) -> None:
+        self.messages: list[bytes] = []
+        self.futures: list[Future] = []
+        self.closed = False
+
+    def write_message(self, message: bytes, binary: bool = False) -> Future:
+        if self.closed:
+            raise WebSocketClosedError()
+        self.messages.append(message)
+        future = get_running_loop().create_future()
+        self.futures.append(future)
+        return future
+
+
+def _start_writer(handler: Any) -> FakeWriter:
+    writer = FakeWriter()
+    handler.write_message = writer.write_message
+    handler._writer = handler.create_task(handler._write_messages())
+    return writer
+
+
+async def test_room_handler_should_write_messages_in_batches(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler()
+    writer = _start_writer(handler)
+
+    await handler.send(b"\x00a")
+    await sleep(0)
+    assert writer.messages == [b"\x00a"]
+
+    # messages sent while a write is being flushed are written together afterwards
+    await handler.send(b"\x00b")
+    await handler.send(b"\x01c")
+    await sleep(0)
+    assert writer.messages == [b"\x00a"]
+
+    writer.futures[-1].set_result(None)
+    await sleep(0)
+    await sleep(0)
+    assert writer.messages == [b"\x00a", b"\x00b", b"\x01c"]
+    assert len(writer.futures) == 3
+    assert not handler._out_messages
+
+    handler._writer.cancel()
+
+
+async def test_room_handler_should_drop_messages_sent_after_close(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler("JupyterLab:globalAwareness")
+    handler.room = TransientRoom("JupyterLab:globalAwareness", log=logging.getLogger())
+    writer = _start_writer(handler)
+    await sleep(0)
+
+    handler.on_close()
+    await sleep(0)
+    await handler.send(b"\x00a")
+    await sleep(0)
+
+    assert handler._writer.done()
+    assert writer.messages == []
+    assert not handler._out_messages
+
+
+async def test_room_handler_should_stop_writing_on_closed_connection(rtc_create_ws_handler):
+    handler = rtc_create_ws_handler()
+    writer = _start_writer(handler)
+
+    await handler.send(b"\x00a")
+    await sleep(0)
+    # the connection closes while the write is being flushed
+    writer.closed = True
+    await handler.send(b"\x00b")
+    writer.futures[-1].set_exception(WebSocketClosedError())
+    await wait_for(handler._writer, timeout=1)
+
+    assert writer.messages == [b"\x00a"]
+    assert not handler._out_messages
+    await handler.send(b"\x00c")
+    assert not handler._out_messages
+
+
+async def _wait_until(condition: Callable[[], bool], timeout: float = 5) -> None:
+    async def _poll() -> None:
+        while not condition():
+            await sleep(0.01)
+
+    await wait_for(_poll(), timeout=timeout)
+
+
+@pytest.mark.parametrize("rtc_document_cleanup_delay", [0.5])
+async def test_room_handler_doc_client_should_keep_room_on_reconnect(
+    rtc_create_file, rtc_connect_doc_client, jp_serverapp
+):
+    path, _ = await rtc_create_file("reconnect.txt", "test")
+    ywebsocket_server = jp_serverapp.web_app.settings["jupyter_server_ydoc"].ywebsocket_server
+
+    async with await rtc_connect_doc_client("text", "file", path):
+        fim = jp_serverapp.web_app.settings["file_id_manager"]
+        room_id = f"text:file:{fim.get_id(path)}"
+        await _wait_until(lambda: room_id in ywebsocket_server.rooms)
+        room = ywebsocket_server.rooms[room_id]
+
+    await _wait_until(lambda: room.cleaner is not None)
+    cleaner = room.cleaner
+
+    async with await rtc_connect_doc_client("text", "file", path):
+        await wait_for(cleaner, timeout=5)
+        await _wait_until(lambda: len(room.clients) == 1)
+        # past the cleanup delay
+        await sleep(0.6)
+
+        assert not cleaner.cancelled()
+        assert ywebsocket_server.rooms.get(room_id) is room
+
+
+async def test_room_handler_should_not_clean_a_recreated_room(rtc_create_ws_handler):
+    server = SimpleNamespace(rooms={}, delete_room=AsyncMock())
+    handler = rtc_create_ws_handler(ywebsocket_server=server, document_cleanup_delay=0)
+    handler._is_document_room = True
+    handler.room = Mock()
+    # the room was cleaned up and a new one was created with the same id
+    server.rooms[handler.path] = Mock()
+
+    await handler._clean_room_later()
+
+    server.delete_room.assert_not_called()
+    assert handler.room is not None
+
+
+@pytest.mark.parametrize(
+    "encoded_path, room_id",
+    [
+        ("/api/collaboration/room/text:file:test-id", "text:file:test-id"),
+        ("/api/collaboration/room/text%3Afile%3Atest-id", "text%3Afile%3Atest-id"),
+        ("/api/collaboration/room/a/b", "b"),
+        ("text:file:test-id", "text:file:test-id"),
+    ],
+)
+def test_room_id_from_encoded_path(encoded_path, room_id):
+    # The handler and YDocExtension.get_document must derive the same room id
+    assert room_id_from_encoded_path(encoded_path) == room_id